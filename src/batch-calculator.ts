@@ -2,47 +2,31 @@
  * 分批计算模块 - 解决 API 限流问题
  */
 
-import type { Env, Fund, FundWithPremium, FundType, BatchProgress, CalculationResult, DailyPremium } from './types';
-import { fetchLOFList, fetchFundNav, fetchHistoricalPrice, fetchFundNavHistory, fetchHistoricalPrices } from './fetcher';
+import type { Env, Fund, FundWithPremium, BatchProgress, CalculationResult, DailyPremium } from './types';
+import {
+  PREMIUM_ARBITRAGE_COST,
+  DISCOUNT_ARBITRAGE_COST,
+  mostCommon,
+  rankPremiumFunds,
+  toFundWithPremium,
+} from './calculator';
+import {
+  FETCH_CONCURRENCY,
+  fetchLOFList,
+  fetchFundNavBatch,
+  fetchHistoricalPrice,
+  fetchFundNavHistory,
+  fetchHistoricalPrices,
+  mapConcurrent,
+} from './fetcher';
 
 const BATCH_SIZE = 10;  // 每批处理的基金数量
-const BATCH_DELAY = 300; // 每个请求间延迟(ms)
-
-// 套利成本 (%)
-const PREMIUM_ARBITRAGE_COST = 0.16;
-const DISCOUNT_ARBITRAGE_COST = 0.51;
-
-// 基金类型关键词
-const QDII_KEYWORDS = ['QDII', '海外', '美股', '港股', '纳斯达克', '标普', '恒生', '日经'];
-const COMMODITY_KEYWORDS = ['原油', '黄金', '白银', '石油', '贵金属', '商品', '有色'];
 
 // KV keys
 const PROGRESS_KEY = 'batch-progress';
 const FUNDS_KEY = 'batch-funds';
 const RESULTS_KEY = 'batch-results';
 
-function detectFundType(name: string): FundType {
-  if (QDII_KEYWORDS.some(kw => name.includes(kw))) return 'qdii';
-  if (COMMODITY_KEYWORDS.some(kw => name.includes(kw))) return 'commodity';
-  return 'normal';
-}
-
-function calculatePremiumRate(marketPrice: number, nav: number): number {
-  if (nav <= 0) return 0;
-  return Number(((marketPrice - nav) / nav * 100).toFixed(2));
-}
-
-function getNavDelayDays(navDate: string): number {
-  const now = new Date();
-  const beijingNow = new Date(now.getTime() + 8 * 60 * 60 * 1000);
-  const todayStr = beijingNow.toISOString().split('T')[0];
-  const navParts = navDate.split('-').map(Number);
-  const todayParts = todayStr.split('-').map(Number);
-  const navDays = Date.UTC(navParts[0], navParts[1] - 1, navParts[2]);
-  const todayDays = Date.UTC(todayParts[0], todayParts[1] - 1, todayParts[2]);
-  return Math.floor((todayDays - navDays) / (1000 * 60 * 60 * 24));
-}
-
 /**
  * 获取当前进度
  */
@@ -128,46 +112,32 @@ export async function processNextBatch(env: Env): Promise<BatchProgress> {
   const batch = funds.slice(start, end);
   const results: FundWithPremium[] = [];
 
-  // 逐个处理基金（串行避免限流）
-  for (const fund of batch) {
+  // 一次性获取本批净值
+  const navMap = await fetchFundNavBatch(batch.map(f => f.code), FETCH_CONCURRENCY, env.LOF_CACHE);
+
+  // 有限并发获取价格
+  const fetched = await mapConcurrent(batch, FETCH_CONCURRENCY, async (fund): Promise<FundWithPremium | null> => {
     try {
-      // 获取净值
-      const nav = await fetchFundNav(fund.code);
+      const nav = navMap.get(fund.code);
       if (!nav) {
-        await delay(BATCH_DELAY);
-        continue;
+        return null;
       }
 
-      // 获取历史价格
+      // 获取历史价格（K 线请求由 fetcher 统一限速）
       const price = await fetchHistoricalPrice(fund.code, nav.navDate);
       if (!price) {
-        await delay(BATCH_DELAY);
-        continue;
+        return null;
       }
 
       // 计算溢价率
-      const fundType = detectFundType(fund.name);
-      const premiumRate = calculatePremiumRate(price, nav.nav);
-      const navDelayDays = getNavDelayDays(nav.navDate);
-      const netProfit = premiumRate > 0
-        ? Number((premiumRate - PREMIUM_ARBITRAGE_COST).toFixed(2))
-        : Number((Math.abs(premiumRate) - DISCOUNT_ARBITRAGE_COST).toFixed(2));
-
-      results.push({
-        ...fund,
-        marketPrice: price,
-        nav: nav.nav,
-        navDate: nav.navDate,
-        fundType,
-        premiumRate,
-        navDelayDays,
-        netProfit,
-      });
+      return toFundWithPremium(fund, price, nav);
     } catch (e) {
       console.error(`处理基金 ${fund.code} 失败:`, e);
+      return null;
     }
-
-    await delay(BATCH_DELAY);
+  });
+  for (const fund of fetched) {
+    if (fund) results.push(fund);
   }
 
   // 保存结果
@@ -193,70 +163,48 @@ async function generateFinalResult(env: Env, progress: BatchProgress): Promise<v
   const allFunds: FundWithPremium[] = resultsData ? JSON.parse(resultsData) : [];
 
   // 筛选溢价基金并排序
-  const premiumFunds = allFunds.filter(f => f.premiumRate > 0);
-  premiumFunds.sort((a, b) => b.premiumRate - a.premiumRate);
+  const premiumFunds = rankPremiumFunds(allFunds);
 
   // 对前10只高溢价基金获取10日历史趋势
   const topFundsForHistory = premiumFunds.slice(0, 10);
 
   console.log(`获取历史趋势: 前${topFundsForHistory.length}只高溢价基金`);
 
-  // 小批量并发获取历史数据
-  const HISTORY_BATCH_SIZE = 3;
-  for (let i = 0; i < topFundsForHistory.length; i += HISTORY_BATCH_SIZE) {
-    const batch = topFundsForHistory.slice(i, i + HISTORY_BATCH_SIZE);
-
-    await Promise.all(batch.map(async (fund) => {
-      try {
-        const [navHistory, priceHistory] = await Promise.all([
-          fetchFundNavHistory(fund.code, 10),
-          fetchHistoricalPrices(fund.code, 10),
-        ]);
-
-        // 计算每日溢价率
-        const premiumHistory: DailyPremium[] = [];
-        const allDates = new Set([...navHistory.keys(), ...priceHistory.keys()]);
-        const sortedDates = Array.from(allDates).sort();
-
-        for (const date of sortedDates) {
-          const nav = navHistory.get(date);
-          const price = priceHistory.get(date);
-          if (nav && price && nav > 0) {
-            premiumHistory.push({
-              date,
-              nav,
-              price,
-              premiumRate: Number(((price - nav) / nav * 100).toFixed(2)),
-            });
-          }
+  // 有限并发获取历史数据
+  await mapConcurrent(topFundsForHistory, FETCH_CONCURRENCY, async (fund) => {
+    try {
+      const [navHistory, priceHistory] = await Promise.all([
+        fetchFundNavHistory(fund.code, 10),
+        fetchHistoricalPrices(fund.code, 10),
+      ]);
+
+      // 计算每日溢价率
+      const premiumHistory: DailyPremium[] = [];
+      const allDates = new Set([...navHistory.keys(), ...priceHistory.keys()]);
+      const sortedDates = Array.from(allDates).sort();
+
+      for (const date of sortedDates) {
+        const nav = navHistory.get(date);
+        const price = priceHistory.get(date);
+        if (nav && price && nav > 0) {
+          premiumHistory.push({
+            date,
+            nav,
+            price,
+            premiumRate: Number(((price - nav) / nav * 100).toFixed(2)),
+          });
         }
-
-        premiumHistory.sort((a, b) => a.date.localeCompare(b.date));
-        fund.premiumHistory = premiumHistory.slice(-10);
-      } catch (e) {
-        console.log(`历史数据获取失败: ${fund.code}`, e);
       }
-    }));
 
-    // 批次间延迟
-    if (i + HISTORY_BATCH_SIZE < topFundsForHistory.length) {
-      await delay(100);
+      premiumHistory.sort((a, b) => a.date.localeCompare(b.date));
+      fund.premiumHistory = premiumHistory.slice(-10);
+    } catch (e) {
+      console.log(`历史数据获取失败: ${fund.code}`, e);
     }
-  }
+  });
 
   // 获取最常见的净值日期
-  const dateCounts = new Map<string, number>();
-  for (const f of allFunds) {
-    dateCounts.set(f.navDate, (dateCounts.get(f.navDate) || 0) + 1);
-  }
-  let mostCommonNavDate = '';
-  let maxCount = 0;
-  for (const [date, count] of dateCounts) {
-    if (count > maxCount) {
-      maxCount = count;
-      mostCommonNavDate = date;
-    }
-  }
+  const mostCommonNavDate = mostCommon(allFunds.map(f => f.navDate)) || '';
 
   const result: CalculationResult = {
     executionTime: new Date().toISOString(),
@@ -298,7 +246,3 @@ export async function resetProgress(env: Env): Promise<void> {
   await env.LOF_CACHE.delete(FUNDS_KEY);
   await env.LOF_CACHE.delete(RESULTS_KEY);
 }
-
-function delay(ms: number): Promise<void> {
-  return new Promise(resolve => setTimeout(resolve, ms));
-}
@@ -2,29 +2,45 @@
  * 溢价率计算模块
  */
 
-import type { Fund, FundType, FundWithPremium, CalculationResult, DailyPremium } from './types';
-import { fetchLOFList, fetchFundNavBatch, fetchHistoricalPrice, fetchFundNavHistory, fetchHistoricalPrices } from './fetcher';
+import type { Env, Fund, FundNav, FundType, FundWithPremium, CalculationResult, DailyPremium } from './types';
+import {
+  FETCH_CONCURRENCY,
+  keywordPattern,
+  memoizeByName,
+  fetchLOFList,
+  fetchFundNavBatch,
+  fetchHistoricalPrice,
+  fetchFundNavHistory,
+  fetchHistoricalPrices,
+  mapConcurrent,
+} from './fetcher';
 
 // 套利成本 (%)
-const PREMIUM_ARBITRAGE_COST = 0.16;   // 溢价套利: 申购+卖出
-const DISCOUNT_ARBITRAGE_COST = 0.51;  // 折价套利: 买入+赎回
+export const PREMIUM_ARBITRAGE_COST = 0.16;   // 溢价套利: 申购+卖出
+export const DISCOUNT_ARBITRAGE_COST = 0.51;  // 折价套利: 买入+赎回
+
+// 单次计算最多处理的基金数量
+const MAX_FUNDS = 30;
 
 // 基金类型关键词
 const QDII_KEYWORDS = ['QDII', '海外', '美股', '港股', '纳斯达克', '标普', '恒生', '日经'];
 const COMMODITY_KEYWORDS = ['原油', '黄金', '白银', '石油', '贵金属', '商品', '有色'];
+// 预编译为单个正则，每个名称只扫描一次
+const QDII_PATTERN = keywordPattern(QDII_KEYWORDS);
+const COMMODITY_PATTERN = keywordPattern(COMMODITY_KEYWORDS);
 
 /**
- * 检测基金类型
+ * 检测基金类型（按名称缓存）
  */
-function detectFundType(name: string): FundType {
-  if (QDII_KEYWORDS.some(kw => name.includes(kw))) {
+const detectFundType = memoizeByName((name: string): FundType => {
+  if (QDII_PATTERN.test(name)) {
     return 'qdii';
   }
-  if (COMMODITY_KEYWORDS.some(kw => name.includes(kw))) {
+  if (COMMODITY_PATTERN.test(name)) {
     return 'commodity';
   }
   return 'normal';
-}
+});
 
 /**
  * 计算净值延迟天数
@@ -54,9 +70,53 @@ function calculatePremiumRate(marketPrice: number, nav: number): number {
 }
 
 /**
- * 找出最常见的值
+ * 构造含溢价率的基金数据
+ * 字段按固定顺序一次性写全（含 premiumHistory），所有对象共享同一结构，
+ * 后续补充历史数据时不会改变对象形状
+ */
+export function toFundWithPremium(fund: Fund, marketPrice: number, nav: FundNav): FundWithPremium {
+  const premiumRate = calculatePremiumRate(marketPrice, nav.nav);
+
+  // 计算净收益（扣除套利成本）
+  const netProfit = premiumRate > 0
+    ? Number((premiumRate - PREMIUM_ARBITRAGE_COST).toFixed(2))
+    : Number((Math.abs(premiumRate) - DISCOUNT_ARBITRAGE_COST).toFixed(2));
+
+  return {
+    code: fund.code,
+    name: fund.name,
+    marketPrice,
+    changePercent: fund.changePercent,
+    nav: nav.nav,
+    navDate: nav.navDate,
+    fundType: detectFundType(fund.name),
+    premiumRate,
+    navDelayDays: getNavDelayDays(nav.navDate),
+    netProfit,
+    premiumHistory: undefined,
+  };
+}
+
+/**
+ * 筛选溢价基金并按溢价率降序排列
+ * 溢价率先抽取到连续的 Float64Array，排序时只比较数组下标，不再反复读取对象属性
  */
-function mostCommon<T>(arr: T[]): T | undefined {
+export function rankPremiumFunds(funds: FundWithPremium[]): FundWithPremium[] {
+  const rates = Float64Array.from(funds, f => f.premiumRate);
+
+  const order: number[] = [];
+  for (let i = 0; i < rates.length; i++) {
+    if (rates[i] > 0) order.push(i);
+  }
+  order.sort((a, b) => rates[b] - rates[a]);
+
+  return order.map(i => funds[i]);
+}
+
+/**
+ * 找出最常见的值（单次遍历计数）
+ */
+export function mostCommon<T>(arr: T[]): T | undefined {
   const counts = new Map<T, number>();
   for (const item of arr) {
     counts.set(item, (counts.get(item) || 0) + 1);
@@ -75,7 +135,7 @@ function mostCommon<T>(arr: T[]): T | undefined {
 /**
  * 计算所有 LOF 基金的溢价率
  */
-export async function calculate(topN: number = 20): Promise<CalculationResult> {
+export async function calculate(env: Env): Promise<CalculationResult> {
   // 1. 获取 LOF 列表
   const allFunds = await fetchLOFList();
 
@@ -85,12 +145,12 @@ export async function calculate(topN: number = 20): Promise<CalculationResult> {
     (a, b) => Math.abs(b.changePercent) - Math.abs(a.changePercent)
   );
 
-  // 限制处理数量以避免超时和限流（最多30只）
-  const funds = sortedFunds.slice(0, 30);
+  // 限制处理数量以避免超时和限流
+  const funds = sortedFunds.slice(0, MAX_FUNDS);
   const codes = funds.map(f => f.code);
 
-  // 3. 批量获取净值（小批量并发）
-  const navMap = await fetchFundNavBatch(codes, 3);  // 更小的批量
+  // 3. 批量获取净值（KV 缓存 + 多基金接口，缺失时逐只回退）
+  const navMap = await fetchFundNavBatch(codes, FETCH_CONCURRENCY, env.LOF_CACHE);
 
   console.log(`净值获取完成: ${navMap.size}/${codes.length}`);
 
@@ -104,18 +164,23 @@ export async function calculate(topN: number = 20): Promise<CalculationResult> {
   }
   const dataDate = mostCommon(navDates) || '';
 
-  // 4. 串行获取历史收盘价（避免并发导致限流）
+  // 4. 有限并发获取历史收盘价（K 线请求由 fetcher 统一限速）
   const priceMap = new Map<string, number>();
   const codesWithNav = Array.from(navMap.keys());
 
-  for (const code of codesWithNav) {
-    const price = await fetchHistoricalPrice(code, dataDate);
-    if (price !== null) {
-      priceMap.set(code, price);
+  await mapConcurrent(
+    codesWithNav,
+    FETCH_CONCURRENCY,
+    code => fetchHistoricalPrice(code, dataDate),
+    (price, code, completed) => {
+      if (price !== null) {
+        priceMap.set(code, price);
+      }
+      if (completed % 10 === 0) {
+        console.log(`价格获取进度: ${completed}/${codesWithNav.length}`);
+      }
     }
-    // 每个请求后短暂延迟
-    await new Promise(resolve => setTimeout(resolve, 50));
-  }
+  );
 
   console.log(`价格获取完成: ${priceMap.size}/${codesWithNav.length}`);
 
@@ -132,81 +197,51 @@ export async function calculate(topN: number = 20): Promise<CalculationResult> {
     // 只使用净值日期与数据日期匹配的基金
     if (nav.navDate !== dataDate) continue;
 
-    const fundType = detectFundType(fund.name);
-    const premiumRate = calculatePremiumRate(historicalPrice, nav.nav);
-    const navDelayDays = getNavDelayDays(nav.navDate);
-
-    // 计算净收益（扣除套利成本）
-    const netProfit = premiumRate > 0
-      ? Number((premiumRate - PREMIUM_ARBITRAGE_COST).toFixed(2))
-      : Number((Math.abs(premiumRate) - DISCOUNT_ARBITRAGE_COST).toFixed(2));
-
-    fundsWithPremium.push({
-      ...fund,
-      marketPrice: historicalPrice, // 使用历史收盘价
-      nav: nav.nav,
-      navDate: nav.navDate,
-      fundType,
-      premiumRate,
-      navDelayDays,
-      netProfit,
-    });
+    // 使用历史收盘价
+    fundsWithPremium.push(toFundWithPremium(fund, historicalPrice, nav));
   }
 
   // 6. 统计
-  const premiumFunds = fundsWithPremium.filter(f => f.premiumRate > 0);
-  premiumFunds.sort((a, b) => b.premiumRate - a.premiumRate);
+  const premiumFunds = rankPremiumFunds(fundsWithPremium);
 
   // 7. 对前10只高溢价基金获取历史数据
   const topFundsForHistory = premiumFunds.slice(0, 10);
 
   console.log(`获取历史数据: 前${topFundsForHistory.length}只高溢价基金`);
 
-  // 小批量并发获取历史数据（净值已缓存，只需获取价格）
-  const BATCH_SIZE = 3;
-  for (let i = 0; i < topFundsForHistory.length; i += BATCH_SIZE) {
-    const batch = topFundsForHistory.slice(i, i + BATCH_SIZE);
-
-    await Promise.all(batch.map(async (fund) => {
-      try {
-        // 净值历史已在 fetchFundNav 时缓存，这里直接读取缓存
-        // 只需要额外获取价格历史
-        const [navHistory, priceHistory] = await Promise.all([
-          fetchFundNavHistory(fund.code, 10),  // 命中缓存，无网络请求
-          fetchHistoricalPrices(fund.code, 10),
-        ]);
-
-        // 计算每日溢价率
-        const premiumHistory: DailyPremium[] = [];
-        const allDates = new Set([...navHistory.keys(), ...priceHistory.keys()]);
-        const sortedDates = Array.from(allDates).sort();
-
-        for (const date of sortedDates) {
-          const nav = navHistory.get(date);
-          const price = priceHistory.get(date);
-          if (nav && price && nav > 0) {
-            premiumHistory.push({
-              date,
-              nav,
-              price,
-              premiumRate: Number(((price - nav) / nav * 100).toFixed(2)),
-            });
-          }
+  // 有限并发获取历史数据（净值历史与价格历史并行获取）
+  await mapConcurrent(topFundsForHistory, FETCH_CONCURRENCY, async (fund) => {
+    try {
+      const [navHistory, priceHistory] = await Promise.all([
+        fetchFundNavHistory(fund.code, 10),
+        fetchHistoricalPrices(fund.code, 10),
+      ]);
+
+      // 计算每日溢价率
+      const premiumHistory: DailyPremium[] = [];
+      const allDates = new Set([...navHistory.keys(), ...priceHistory.keys()]);
+      const sortedDates = Array.from(allDates).sort();
+
+      for (const date of sortedDates) {
+        const nav = navHistory.get(date);
+        const price = priceHistory.get(date);
+        if (nav && price && nav > 0) {
+          premiumHistory.push({
+            date,
+            nav,
+            price,
+            premiumRate: Number(((price - nav) / nav * 100).toFixed(2)),
+          });
         }
-
-        // 按日期排序,保留最近10条
-        premiumHistory.sort((a, b) => a.date.localeCompare(b.date));
-        fund.premiumHistory = premiumHistory.slice(-10);
-      } catch (e) {
-        console.log(`历史数据获取失败: ${fund.code}`, e);
       }
-    }));
 
-    // 批次间延迟避免限流
-    if (i + BATCH_SIZE < topFundsForHistory.length) {
-      await new Promise(resolve => setTimeout(resolve, 100));
+      // 按日期排序,保留最近10条
+      premiumHistory.sort((a, b) => a.date.localeCompare(b.date));
+      fund.premiumHistory = premiumHistory.slice(-10);
+    } catch (e) {
+      console.log(`历史数据获取失败: ${fund.code}`, e);
     }
-  }
+  });
 
   const executionTime = new Date().toISOString();
 
@@ -237,35 +272,25 @@ export async function calculate(topN: number = 20): Promise<CalculationResult> {
  * 格式化报告（文本格式）
  */
 export function formatReport(result: CalculationResult, topN: number = 10): string {
-  const lines: string[] = [];
-
-  lines.push('LOF基金溢价率报告');
-  lines.push('='.repeat(50));
-  lines.push(`计算时间: ${result.executionTime}`);
-
   const total = result.successCount + result.failedCount;
-  if (total > 0) {
-    const rate = (result.successCount / total * 100).toFixed(1);
-    lines.push(`数据成功率: ${result.successCount}/${total} (${rate}%)`);
-  }
-
-  lines.push(`溢价基金数量: ${result.premiumFundCount} 只`);
-
-  if (result.mostCommonNavDate) {
-    lines.push(`净值日期(T-1): ${result.mostCommonNavDate}`);
-  }
-
-  lines.push('');
-  lines.push('套利成本参考:');
-  lines.push(`  溢价套利(申购+卖出): ${result.arbitrageCosts.premium}%`);
-  lines.push(`  折价套利(买入+赎回): ${result.arbitrageCosts.discount}%`);
+  const successLine = total > 0
+    ? `数据成功率: ${result.successCount}/${total} (${(result.successCount / total * 100).toFixed(1)}%)\n`
+    : '';
+  const navDateLine = result.mostCommonNavDate
+    ? `净值日期(T-1): ${result.mostCommonNavDate}\n`
+    : '';
+
+  let report = `LOF基金溢价率报告
+${'='.repeat(50)}
+计算时间: ${result.executionTime}
+${successLine}溢价基金数量: ${result.premiumFundCount} 只
+${navDateLine}
+套利成本参考:
+  溢价套利(申购+卖出): ${result.arbitrageCosts.premium}%
+  折价套利(买入+赎回): ${result.arbitrageCosts.discount}%`;
 
   if (result.topPremiumFunds.length > 0) {
-    lines.push('');
-    lines.push(`溢价率最高的LOF基金 (TOP ${topN}):`);
-
-    for (let i = 0; i < Math.min(topN, result.topPremiumFunds.length); i++) {
-      const fund = result.topPremiumFunds[i];
+    const topLines = result.topPremiumFunds.slice(0, Math.max(0, topN)).map((fund, i) => {
       let typeTag = '';
       let warning = '';
 
@@ -281,11 +306,11 @@ export function formatReport(result: CalculationResult, topN: number = 10): stri
         ? `净收益${fund.netProfit}%`
         : '无套利空间';
 
-      lines.push(
-        `  ${i + 1}. ${fund.code} ${fund.name} ${typeTag}溢价率: ${fund.premiumRate.toFixed(2)}% (${profit})${warning}`
-      );
-    }
+      return `  ${i + 1}. ${fund.code} ${fund.name} ${typeTag}溢价率: ${fund.premiumRate.toFixed(2)}% (${profit})${warning}`;
+    });
+
+    report += `\n\n${[`溢价率最高的LOF基金 (TOP ${topN}):`, ...topLines].join('\n')}`;
   }
 
-  return lines.join('\n');
+  return report;
 }
@@ -6,11 +6,143 @@ import type { Fund, FundNav } from './types';
 
 const USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36';
 
+// 价格有效区间
+const MIN_PRICE = 0.5;
+const MAX_PRICE = 100;
+
+/**
+ * 将关键词列表编译为单个正则（逐个转义，按字面匹配）
+ */
+export function keywordPattern(keywords: string[]): RegExp {
+  return new RegExp(keywords.map(kw => kw.replace(/[.*+?^${}()|[\]\\]/g, '\\$&')).join('|'));
+}
+
+// 债券/货币类基金关键词（跳过）
+const SKIP_KEYWORDS = ['债券', '货币', '短债', '纯债', '中债', '国债', '信用债', '可转债', '企业债', '政府债', '同业存单'];
+// 预编译为单个正则，每个名称只扫描一次
+const SKIP_PATTERN = keywordPattern(SKIP_KEYWORDS);
+
+/**
+ * 按基金名称缓存判定结果
+ * LOF 名单基本稳定，isolate 复用时同一名称无需重复匹配；超过上限时整体清空
+ */
+export function memoizeByName<T>(fn: (name: string) => T, maxSize: number = 4096): (name: string) => T {
+  const cache = new Map<string, T>();
+  return (name: string): T => {
+    if (cache.has(name)) {
+      return cache.get(name)!;
+    }
+    if (cache.size >= maxSize) cache.clear();
+    const result = fn(name);
+    cache.set(name, result);
+    return result;
+  };
+}
+
+/**
+ * 判断是否为债券/货币类基金
+ */
+const isSkippedByName = memoizeByName(name => SKIP_PATTERN.test(name));
+
+// 净值 KV 缓存（按北京时间日期分键）
+// 净值每个交易日只更新一次，TTL 取 4 小时以便晚间公布的新净值能及时生效
+const NAV_CACHE_KEY_PREFIX = 'nav-cache:';
+const NAV_CACHE_TTL = 4 * 60 * 60;
+
+// KV 中的净值条目，fetchedAt 用于逐条判断是否过期
+interface CachedNav extends FundNav {
+  fetchedAt: number;
+}
+
+// LOF 列表接口单条记录 (fltt=2 时数值字段已是 number，停牌等无数据时为 '-')
+interface ClistItem {
+  f2?: number | string;   // 最新价
+  f3?: number | string;   // 涨跌幅
+  f12?: string;           // 代码
+  f14?: string;           // 名称
+}
+
+// LOF 列表缓存（isolate 复用时跨请求共享，行情变化快，只保留 1 分钟）
+const LOF_LIST_TTL = 60 * 1000;
+let lofListCache: { fetchedAt: number; funds: Fund[] } | null = null;
+
 // 历史价格缓存 (code -> date -> closePrice)
 const priceCache = new Map<string, Map<string, number>>();
+// 历史价格缓存写入时间 (code -> timestamp)，isolate 可能跨天复用
+const priceCacheTime = new Map<string, number>();
+const PRICE_CACHE_MAX_AGE = 10 * 60 * 1000;
 
-// 净值历史缓存 (code -> date -> nav) - 复用pingzhongdata请求
+// 净值历史缓存 (code -> date -> nav)
 const navHistoryCache = new Map<string, Map<string, number>>();
+// 净值历史缓存写入时间 (code -> timestamp)，同样避免 isolate 跨天复用旧数据
+const navHistoryCacheTime = new Map<string, number>();
+const NAV_HISTORY_CACHE_MAX_AGE = 10 * 60 * 1000;
+
+// 并发请求数（mapConcurrent 不会超过待处理数量）
+export const FETCH_CONCURRENCY = 5;
+
+/**
+ * 延迟（异步等待，不阻塞其他并发请求）
+ */
+function delay(ms: number): Promise<void> {
+  return new Promise(resolve => setTimeout(resolve, ms));
+}
+
+// K 线接口限流时会返回 200 + 空数据，不会触发重试
+// 因此所有 K 线请求（不论来自哪个并发 worker）按固定间隔依次发出，总速率与并发数无关
+const KLINE_REQUEST_INTERVAL = 300;
+let klineNextSlot = 0;
+
+/**
+ * 等待下一个 K 线请求时间槽（只在真正发起网络请求前调用，命中缓存不占用）
+ */
+async function paceKlineRequest(): Promise<void> {
+  const now = Date.now();
+  const slot = Math.max(now, klineNextSlot);
+  klineNextSlot = slot + KLINE_REQUEST_INTERVAL;
+  if (slot > now) {
+    await delay(slot - now);
+  }
+}
+
+// 重试等待上限(ms)
+const RETRY_DELAY_CAP = 5000;
+
+/**
+ * 带重试的 fetch
+ * 网络异常或限流/服务端错误 (429, 5xx) 时等待后重试
+ * 最终返回的非 2xx 响应 body 已取消（释放连接），调用方只应读取 status
+ * 等待时间采用去相关抖动 (decorrelated jitter)，避免并发请求在同一时刻集中重试
+ */
+async function fetchWithRetry(
+  url: string,
+  init: RequestInit,
+  maxRetries: number = 2,
+  retryDelay: number = 500
+): Promise<Response> {
+  let wait = retryDelay;
+  for (let attempt = 0; ; attempt++) {
+    try {
+      const res = await fetch(url, init);
+      if (attempt >= maxRetries || (res.status !== 429 && res.status < 500)) {
+        if (!res.ok) {
+          await res.body?.cancel();
+        }
+        return res;
+      }
+      console.log(`HTTP ${res.status}, 重试 ${attempt + 1}/${maxRetries}: ${url}`);
+      // 丢弃的响应需取消 body，否则连接一直占用（单次调用最多 6 个并发连接）
+      await res.body?.cancel();
+    } catch (e) {
+      if (attempt >= maxRetries) {
+        throw e;
+      }
+      console.log(`请求异常, 重试 ${attempt + 1}/${maxRetries}: ${url}`);
+    }
+    wait = Math.min(RETRY_DELAY_CAP, retryDelay + Math.random() * (wait * 3 - retryDelay));
+    await delay(wait);
+  }
+}
 
 /**
  * 获取基金历史收盘价
@@ -34,7 +166,8 @@ export async function fetchHistoricalPrice(code: string, date: string): Promise<
   const url = `https://push2his.eastmoney.com/api/qt/stock/kline/get?secid=${prefix}.${code}&fields1=f1,f2,f3&fields2=f51,f52,f53,f54,f55&klt=101&fqt=0&end=20500101&lmt=30`;
 
   try {
-    const res = await fetch(url, {
+    await paceKlineRequest();
+    const res = await fetchWithRetry(url, {
       headers: {
         'User-Agent': USER_AGENT,
         'Referer': 'https://quote.eastmoney.com/',
@@ -66,6 +199,7 @@ export async function fetchHistoricalPrice(code: string, date: string): Promise<
     }
 
     priceCache.set(code, dateMap);
+    priceCacheTime.set(code, Date.now());
     const price = dateMap.get(date);
     if (!price) {
       console.log(`No price for ${code} on ${date}, available: ${Array.from(dateMap.keys()).slice(-3).join(',')}`);
@@ -79,8 +213,13 @@ export async function fetchHistoricalPrice(code: string, date: string): Promise<
 
 /**
  * 获取 LOF 基金列表（分页获取全部）
+ * 1 分钟内重复调用直接返回缓存
  */
 export async function fetchLOFList(): Promise<Fund[]> {
+  if (lofListCache && Date.now() - lofListCache.fetchedAt < LOF_LIST_TTL) {
+    return lofListCache.funds;
+  }
+
   const baseUrl = 'https://88.push2.eastmoney.com/api/qt/clist/get';
   const baseParams = {
     pn: '1',
@@ -103,9 +242,12 @@ export async function fetchLOFList(): Promise<Fund[]> {
 
   // 获取第一页，确定总数
   const firstUrl = `${baseUrl}?${new URLSearchParams(baseParams)}`;
-  const firstRes = await fetch(firstUrl, { headers });
+  const firstRes = await fetchWithRetry(firstUrl, { headers });
+  if (!firstRes.ok) {
+    throw new Error(`获取 LOF 列表失败: HTTP ${firstRes.status}`);
+  }
   const firstData = await firstRes.json() as {
-    data: { diff: Record<string, unknown>[]; total: number };
+    data: { diff: unknown; total: number };
   };
 
   if (!firstData.data?.diff) {
@@ -113,9 +255,9 @@ export async function fetchLOFList(): Promise<Fund[]> {
   }
 
   // diff 可能是对象或数组，统一转为数组
-  const toArray = (diff: unknown): Record<string, unknown>[] => {
+  const toArray = (diff: unknown): ClistItem[] => {
     if (Array.isArray(diff)) return diff;
-    if (diff && typeof diff === 'object') return Object.values(diff);
+    if (diff && typeof diff === 'object') return Object.values(diff) as ClistItem[];
     return [];
   };
 
@@ -124,40 +266,57 @@ export async function fetchLOFList(): Promise<Fund[]> {
   const totalPages = Math.ceil(total / 100);
 
   // 获取剩余页面
-  const promises: Promise<Response>[] = [];
+  const promises: Promise<{ data: { diff: unknown } }>[] = [];
   for (let page = 2; page <= totalPages; page++) {
     const params = { ...baseParams, pn: String(page) };
     const url = `${baseUrl}?${new URLSearchParams(params)}`;
-    promises.push(fetch(url, { headers }));
+    promises.push(fetchWithRetry(url, { headers }).then(res => {
+      if (!res.ok) {
+        console.log(`LOF 列表第 ${page} 页获取失败: HTTP ${res.status}`);
+        return { data: { diff: null } };
+      }
+      return res.json() as Promise<{ data: { diff: unknown } }>;
+    }));
   }
 
-  const responses = await Promise.all(promises);
-  for (const res of responses) {
-    const data = await res.json() as { data: { diff: unknown } };
+  const pages = await Promise.all(promises);
+  for (const data of pages) {
     if (data.data?.diff) {
       allRecords.push(...toArray(data.data.diff));
     }
   }
 
-  // 转换为 Fund 对象
+  // 转换为 Fund 对象，一次遍历完成筛选
+  // 分页按涨跌幅排序，翻页期间行情变动会让同一基金出现在多页，按代码去重
   const funds: Fund[] = [];
+  const seen = new Set<string>();
+  const skipped = { invalid: 0, duplicate: 0, price: 0, keyword: 0 };
+
   for (const item of allRecords) {
-    const code = String(item.f12 || '');
-    const name = String(item.f14 || '');
-    const price = item.f2;
+    const code = item.f12;
+    const name = item.f14;
+    const marketPrice = item.f2;
 
-    if (!code || !name || price === null || price === '-') {
+    // 无数据时价格为 '-'，直接按类型判断，无需逐条转换
+    if (!code || !name || typeof marketPrice !== 'number') {
+      skipped.invalid++;
       continue;
     }
 
-    const marketPrice = Number(price);
-    if (isNaN(marketPrice) || marketPrice <= 0 || marketPrice > 100 || marketPrice < 0.5) {
+    if (seen.has(code)) {
+      skipped.duplicate++;
+      continue;
+    }
+    seen.add(code);
+
+    if (marketPrice < MIN_PRICE || marketPrice > MAX_PRICE) {
+      skipped.price++;
       continue;
     }
 
     // 跳过债券/货币类基金
-    const skipKeywords = ['债券', '货币', '短债', '纯债', '中债', '国债', '信用债', '可转债', '企业债', '政府债', '同业存单'];
-    if (skipKeywords.some(kw => name.includes(kw))) {
+    if (isSkippedByName(name)) {
+      skipped.keyword++;
       continue;
     }
 
@@ -165,59 +324,67 @@ export async function fetchLOFList(): Promise<Fund[]> {
       code,
       name,
       marketPrice,
-      changePercent: Number(item.f3) || 0,
+      changePercent: typeof item.f3 === 'number' ? item.f3 : 0,
     });
   }
 
+  console.log(`LOF 列表: ${funds.length}/${allRecords.length} (无效${skipped.invalid}, 重复${skipped.duplicate}, 价格${skipped.price}, 债券/货币${skipped.keyword})`);
+
+  lofListCache = { fetchedAt: Date.now(), funds };
   return funds;
 }
 
 /**
- * 获取基金净值（通过解析 JS 文件）
- * 同时缓存历史净值数据供后续复用
+ * 从 pingzhongdata JS 文件中提取 Data_netWorthTrend 数组
+ * 文件有数百 KB，用 indexOf 定位后只解析这一段，避免正则在全文上回溯
+ */
+function extractNetWorthTrend(text: string): Array<{ x: number; y: number }> | null {
+  const varIndex = text.indexOf('var Data_netWorthTrend');
+  if (varIndex < 0) {
+    return null;
+  }
+
+  const start = text.indexOf('[', varIndex);
+  const end = text.indexOf('];', start);
+  if (start < 0 || end < 0) {
+    return null;
+  }
+
+  return JSON.parse(text.slice(start, end + 1)) as Array<{ x: number; y: number }>;
+}
+
+/**
+ * 获取基金最新净值（历史净值接口只取第一条，响应不足 1 KB）
  */
 export async function fetchFundNav(code: string): Promise<FundNav | null> {
-  const url = `https://fund.eastmoney.com/pingzhongdata/${code}.js`;
+  const url = `https://api.fund.eastmoney.com/f10/lsjz?fundCode=${code}&pageIndex=1&pageSize=1`;
 
   try {
-    const res = await fetch(url, {
-      headers: { 'User-Agent': USER_AGENT },
+    const res = await fetchWithRetry(url, {
+      headers: {
+        'User-Agent': USER_AGENT,
+        'Referer': 'https://fundf10.eastmoney.com/',
+      },
     });
 
     if (!res.ok) {
       return null;
     }
 
-    const text = await res.text();
-
-    // 用正则提取 Data_netWorthTrend 变量
-    const match = text.match(/var Data_netWorthTrend\s*=\s*(\[[\s\S]*?\]);/);
-    if (!match) {
-      return null;
-    }
+    const data = await res.json() as {
+      Data?: { LSJZList?: Array<{ FSRQ?: string; DWJZ?: string }> } | null;
+    };
 
-    const data = JSON.parse(match[1]) as Array<{ x: number; y: number }>;
-    if (!data || data.length === 0) {
+    // 按日期倒序，第一条即最新净值
+    const latest = data.Data?.LSJZList?.[0];
+    const nav = Number(latest?.DWJZ);
+    if (!latest?.FSRQ || isNaN(nav) || nav <= 0) {
       return null;
     }
 
-    // 缓存所有历史净值数据（复用此次请求）
-    const historyMap = new Map<string, number>();
-    for (const item of data) {
-      const d = new Date(item.x + 8 * 60 * 60 * 1000);
-      const dateStr = d.toISOString().split('T')[0];
-      historyMap.set(dateStr, item.y);
-    }
-    navHistoryCache.set(code, historyMap);
-
-    const latest = data[data.length - 1];
-    // 时间戳是北京时间0点，需要转换为中国日期
-    const date = new Date(latest.x + 8 * 60 * 60 * 1000); // 加8小时转UTC+8
-    const navDate = date.toISOString().split('T')[0];
-
     return {
-      nav: latest.y,
-      navDate,
+      nav,
+      navDate: latest.FSRQ,
     };
   } catch {
     return null;
@@ -229,8 +396,9 @@ export async function fetchFundNav(code: string): Promise<FundNav | null> {
  * 优先使用缓存，避免重复请求
  */
 export async function fetchFundNavHistory(code: string, days: number = 10): Promise<Map<string, number>> {
-  // 检查缓存（fetchFundNav已经缓存过）
-  if (navHistoryCache.has(code)) {
+  // 检查缓存
+  const cachedAt = navHistoryCacheTime.get(code) || 0;
+  if (navHistoryCache.has(code) && Date.now() - cachedAt < NAV_HISTORY_CACHE_MAX_AGE) {
     const cached = navHistoryCache.get(code)!;
     const sortedDates = Array.from(cached.keys()).sort();
     const recentDates = sortedDates.slice(-days);
@@ -246,7 +414,7 @@ export async function fetchFundNavHistory(code: string, days: number = 10): Prom
   const result = new Map<string, number>();
 
   try {
-    const res = await fetch(url, {
+    const res = await fetchWithRetry(url, {
       headers: { 'User-Agent': USER_AGENT },
     });
 
@@ -256,13 +424,7 @@ export async function fetchFundNavHistory(code: string, days: number = 10): Prom
 
     const text = await res.text();
 
-    // 用正则提取 Data_netWorthTrend 变量
-    const match = text.match(/var Data_netWorthTrend\s*=\s*(\[[\s\S]*?\]);/);
-    if (!match) {
-      return result;
-    }
-
-    const data = JSON.parse(match[1]) as Array<{ x: number; y: number }>;
+    const data = extractNetWorthTrend(text);
     if (!data || data.length === 0) {
       return result;
     }
@@ -275,6 +437,7 @@ export async function fetchFundNavHistory(code: string, days: number = 10): Prom
       historyMap.set(dateStr, item.y);
     }
     navHistoryCache.set(code, historyMap);
+    navHistoryCacheTime.set(code, Date.now());
 
     // 取最近 N 天的数据
     const recentData = data.slice(-days);
@@ -292,16 +455,28 @@ export async function fetchFundNavHistory(code: string, days: number = 10): Prom
 
 /**
  * 获取多日历史收盘价（返回 Map<date, price>）
+ * 优先复用 fetchHistoricalPrice 已缓存的 K 线，避免对同一基金重复请求
  */
 export async function fetchHistoricalPrices(code: string, days: number = 10): Promise<Map<string, number>> {
+  const result = new Map<string, number>();
+
+  // 检查缓存（K 线按日期升序写入）
+  const cached = priceCache.get(code);
+  const cachedAt = priceCacheTime.get(code) || 0;
+  if (cached && cached.size >= days && Date.now() - cachedAt < PRICE_CACHE_MAX_AGE) {
+    for (const [d, close] of Array.from(cached).slice(-days)) {
+      result.set(d, close);
+    }
+    return result;
+  }
+
   // 确定交易所前缀 (深圳1开头用0，上海5开头用1)
   const prefix = code.startsWith('5') ? '1' : '0';
   const url = `https://push2his.eastmoney.com/api/qt/stock/kline/get?secid=${prefix}.${code}&fields1=f1,f2,f3&fields2=f51,f52,f53,f54,f55&klt=101&fqt=0&end=20500101&lmt=${days + 5}`;
 
-  const result = new Map<string, number>();
-
   try {
-    const res = await fetch(url, {
+    await paceKlineRequest();
+    const res = await fetchWithRetry(url, {
       headers: {
         'User-Agent': USER_AGENT,
         'Referer': 'https://quote.eastmoney.com/',
@@ -337,33 +512,151 @@ export async function fetchHistoricalPrices(code: string, days: number = 10): Pr
 }
 
 /**
- * 批量获取基金净值（小批量并发）
+ * 有限并发执行（worker 池）
+ * 任一请求完成即补位下一个，不会因整批等待最慢的请求而阻塞
+ * onResult 按完成顺序逐个回调，便于边完成边处理/输出进度
+ */
+export async function mapConcurrent<T, R>(
+  items: T[],
+  concurrency: number,
+  fn: (item: T) => Promise<R>,
+  onResult?: (result: R, item: T, completed: number) => void
+): Promise<R[]> {
+  const results = new Array<R>(items.length);
+  let next = 0;
+  let completed = 0;
+
+  const worker = async (): Promise<void> => {
+    while (next < items.length) {
+      const index = next++;
+      results[index] = await fn(items[index]);
+      onResult?.(results[index], items[index], ++completed);
+    }
+  };
+
+  const workerCount = Math.max(1, Math.min(concurrency, items.length));
+  await Promise.all(Array.from({ length: workerCount }, worker));
+  return results;
+}
+
+/**
+ * 批量获取基金最新净值（单次请求查询多只基金）
+ */
+export async function fetchFundNavMulti(codes: string[]): Promise<Map<string, FundNav>> {
+  const results = new Map<string, FundNav>();
+  const CHUNK_SIZE = 50;
+
+  const chunks: string[][] = [];
+  for (let i = 0; i < codes.length; i += CHUNK_SIZE) {
+    chunks.push(codes.slice(i, i + CHUNK_SIZE));
+  }
+
+  await Promise.all(chunks.map(async (chunk) => {
+    const params = {
+      pageIndex: '1',
+      pageSize: String(chunk.length),
+      plat: 'Android',
+      appType: 'ttjj',
+      product: 'EFund',
+      Version: '1',
+      deviceid: 'lof-premium-calculator',
+      Fcodes: chunk.join(','),
+    };
+    const url = `https://fundmobapi.eastmoney.com/FundMNewApi/FundMNFInfo?${new URLSearchParams(params)}`;
+
+    try {
+      const res = await fetchWithRetry(url, {
+        headers: { 'User-Agent': USER_AGENT },
+      });
+
+      if (!res.ok) {
+        console.log(`Multi NAV fetch failed: HTTP ${res.status}`);
+        return;
+      }
+
+      const data = await res.json() as {
+        Datas?: Array<{ FCODE?: string; NAV?: string | number; PDATE?: string }> | null;
+      };
+
+      for (const item of data.Datas || []) {
+        const nav = Number(item.NAV);
+        // PDATE 格式: YYYY-MM-DD，无净值时为 '--'
+        if (!item.FCODE || isNaN(nav) || nav <= 0 || !/^\d{4}-\d{2}-\d{2}$/.test(item.PDATE || '')) {
+          continue;
+        }
+        results.set(item.FCODE, { nav, navDate: item.PDATE! });
+      }
+    } catch (e) {
+      console.log(`Multi NAV fetch error: ${e}`);
+    }
+  }));
+
+  return results;
+}
+
+/**
+ * 获取北京时间当天日期 (YYYY-MM-DD)
+ */
+function getBeijingDate(): string {
+  return new Date(Date.now() + 8 * 60 * 60 * 1000).toISOString().split('T')[0];
+}
+
+/**
+ * 批量获取基金净值
+ * 先读 KV 缓存，再用多基金接口一次取回，缺失的逐只回退获取（有限并发）
  */
 export async function fetchFundNavBatch(
   codes: string[],
-  concurrency: number = 5
+  concurrency: number = FETCH_CONCURRENCY,
+  cache?: KVNamespace
 ): Promise<Map<string, FundNav>> {
+  const cacheKey = NAV_CACHE_KEY_PREFIX + getBeijingDate();
+  const stored: Record<string, CachedNav> = cache
+    ? await cache.get<Record<string, CachedNav>>(cacheKey, 'json') || {}
+    : {};
+
+  // 逐条检查写入时间：整个 key 每次写回都会续期，不能只依赖 expirationTtl
+  const now = Date.now();
+  const cached: Record<string, CachedNav> = {};
+  for (const [code, entry] of Object.entries(stored)) {
+    if (now - entry.fetchedAt < NAV_CACHE_TTL * 1000) {
+      cached[code] = entry;
+    }
+  }
+
   const results = new Map<string, FundNav>();
+  for (const code of codes) {
+    const entry = cached[code];
+    if (entry) {
+      results.set(code, { nav: entry.nav, navDate: entry.navDate });
+    }
+  }
 
-  // 分批处理
-  for (let i = 0; i < codes.length; i += concurrency) {
-    const batch = codes.slice(i, i + concurrency);
-    const promises = batch.map(async (code) => {
-      const nav = await fetchFundNav(code);
-      return { code, nav };
-    });
+  const uncached = codes.filter(code => !results.has(code));
+  if (uncached.length === 0) {
+    console.log(`净值全部命中缓存: ${results.size} 只`);
+    return results;
+  }
+
+  const fetched = await fetchFundNavMulti(uncached);
 
-    const batchResults = await Promise.all(promises);
-    for (const { code, nav } of batchResults) {
+  const missing = uncached.filter(code => !fetched.has(code));
+  if (missing.length > 0) {
+    console.log(`多基金接口缺失 ${missing.length} 只，逐只回退获取`);
+    await mapConcurrent(missing, concurrency, fetchFundNav, (nav, code) => {
       if (nav) {
-        results.set(code, nav);
+        fetched.set(code, nav);
       }
-    }
+    });
+  }
 
-    // 批次间延迟避免限流
-    if (i + concurrency < codes.length) {
-      await new Promise(resolve => setTimeout(resolve, 150));
-    }
+  for (const [code, nav] of fetched) {
+    results.set(code, nav);
+    cached[code] = { nav: nav.nav, navDate: nav.navDate, fetchedAt: now };
+  }
+
+  if (cache && fetched.size > 0) {
+    await cache.put(cacheKey, JSON.stringify(cached), { expirationTtl: NAV_CACHE_TTL });
   }
 
   return results;
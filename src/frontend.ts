@@ -337,7 +337,7 @@ body {
 <script>
 const $=id=>document.getElementById(id);
 const N=30;
-let allData=[],filtered=[],expanded=false,sortKey='premiumRate',sortAsc=false,showAll=false;
+let allData=[],byCode=new Map(),filtered=[],expanded=false,sortKey='premiumRate',sortAsc=false,showAll=false;
 
 // 迷你趋势图
 function spark(d,code){
@@ -419,7 +419,7 @@ function bindSparkTip(){
   document.querySelectorAll('.spark').forEach(svg=>{
     svg.onmouseenter=e=>{
       const code=svg.dataset.code;
-      const fund=allData.find(f=>f.code===code);
+      const fund=byCode.get(code);
       if(!fund||!fund.premiumHistory||fund.premiumHistory.length<2)return;
       const h=fund.premiumHistory;
       const first=h[0],last=h[h.length-1];
@@ -493,6 +493,7 @@ async function load(){
     if(!r.ok)throw new Error('HTTP '+r.status);
     const j=await r.json();
     allData=j.topPremiumFunds||[];
+    byCode=new Map(allData.map(f=>[f.code,f]));
 
     // 更新统计
     $('navDate').textContent=j.mostCommonNavDate||'-';
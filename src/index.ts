@@ -173,7 +173,7 @@ async function handleCalculate(
   const format = url.searchParams.get('format') || 'json';
 
   try {
-    const result = await calculate(topN);
+    const result = await calculate(env);
 
     // 更新缓存
     await setCachedData(env, result);
@@ -214,7 +214,7 @@ async function handleData(
 
   // 无缓存时自动触发计算
   if (!cached) {
-    const result = await calculate(100);
+    const result = await calculate(env);
     await setCachedData(env, result);
     cached = {
       result,
@@ -332,7 +332,7 @@ async function handleScheduled(env: Env): Promise<void> {
   console.log('Cron triggered: 开始计算溢价率...');
 
   try {
-    const result = await calculate(50);
+    const result = await calculate(env);
     await setCachedData(env, result);
 
     console.log(`计算完成: ${result.successCount} 只基金, ${result.premiumFundCount} 只溢价`);
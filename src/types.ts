@@ -7,18 +7,18 @@ export type FundType = 'normal' | 'qdii' | 'commodity';
  * 基金基础数据
  */
 export interface Fund {
-  code: string;           // 基金代码
-  name: string;           // 基金名称
-  marketPrice: number;    // 场内交易价格
-  changePercent: number;  // 涨跌幅
+  readonly code: string;           // 基金代码
+  readonly name: string;           // 基金名称
+  readonly marketPrice: number;    // 场内交易价格
+  readonly changePercent: number;  // 涨跌幅
 }
 
 /**
  * 基金净值数据
  */
 export interface FundNav {
-  nav: number;            // 单位净值
-  navDate: string;        // 净值日期 (YYYY-MM-DD)
+  readonly nav: number;            // 单位净值
+  readonly navDate: string;        // 净值日期 (YYYY-MM-DD)
 }
 
 /**